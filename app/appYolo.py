@@ -89,6 +89,7 @@ cap = cv2.VideoCapture("video_prova.MOV")
 model = models.create("resnet50", num_features=2048, dropout=0, num_classes=751, last_stride=2, norm=True)
 m = load_model("../tricks/logs/model_best.pth.tar")
 model.load_state_dict(m['state_dict'])
+model.eval()
 
 if torch.backends.mps.is_available():
     model = model.to('mps')
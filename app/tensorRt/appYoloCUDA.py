@@ -78,6 +78,7 @@ pred = Predictor(engine_path="yolov7-tiny.trt")
 model = models.create("resnet50", num_features=2048, dropout=0, num_classes=751, last_stride=2, norm=True)
 m = load_model("../../tricks/logs/model_best.pth.tar")
 model.load_state_dict(m['state_dict'])
+model.eval()
 
 model = model.cuda()
 # ---------------------------------------------------------
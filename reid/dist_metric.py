@@ -12,18 +12,21 @@ class DistanceMetric(object):
         self.algorithm = algorithm
         self.metric = get_metric(algorithm, *args, **kwargs)
 
-    def train(self, model, data_loader):
+    def train(self, model, data_loader, transform=None):
         if self.algorithm == 'euclidean' or self.algorithm == 'cosine': return
-        features, labels = extract_features(model, data_loader)
-        features = torch.stack(features.values()).numpy()
-        labels = torch.Tensor(list(labels.values())).numpy()
+        (features, _), labels = extract_features(model, data_loader, transform=transform)
+        features = features.numpy()
+        labels = labels.numpy()
         self.metric.fit(features, labels)
 
     def transform(self, X):
+        # Both are the identity, so device tensors do not have to round-trip through numpy
+        if self.algorithm == 'euclidean' or self.algorithm == 'cosine': return X
         if torch.is_tensor(X):
-            X = X.numpy()
+            device = X.device
+            X = X.cpu().numpy()
             X = self.metric.transform(X)
-            X = torch.from_numpy(X)
+            X = torch.from_numpy(X).to(device)
         else:
             X = self.metric.transform(X)
         return X
@@ -1,108 +1,349 @@
 from __future__ import print_function, absolute_import
 
-from collections import OrderedDict
+from torch.nn import functional as F
+from scipy import sparse
+import os.path as osp
 import numpy as np
+import hashlib
+import bisect
+import numba
 import torch
 import time
 
 from .feature_extraction import extract_cnn_feature
 from .evaluation_metrics import cmc, mean_ap
+from .evaluators_numba import k_reciprocal_expansion, jaccard_distance
 from .utils.meters import AverageMeter
+from .utils import to_numpy
+from .utils.osutils import mkdir_if_missing
+
+def _try_compile(fn, **kwargs):
+    # torch.compile only exists from torch 2.0 and raises RuntimeError where it is not
+    # supported (e.g. torch 2.0 on Python 3.11, Windows before torch 2.2), in which case
+    # None is returned and the caller keeps running eagerly
+    if not hasattr(torch, 'compile'):
+        return None
+    try:
+        return torch.compile(fn, **kwargs)
+    except RuntimeError:
+        return None
+
+def _pairwise_euclid(x, y=None):
+    # Squared euclidean distances as |x|^2 + |y|^2 - 2 x.y^T: one GEMM plus two row
+    # reductions instead of cdist's per-pair kernel. Rounding can leave tiny negatives.
+    # Without y the distances are between the rows of x and its norms are reused
+    x_sq = x.pow(2).sum(dim=1, keepdim=True)
+    if y is None:
+        y, y_sq = x, x_sq
+    else:
+        y_sq = y.pow(2).sum(dim=1, keepdim=True)
+    return (x_sq + y_sq.t()).addmm_(x, y.t(), alpha=-2).clamp_min_(0)
+
+# device type -> whether nonzero_static has a kernel there, probed on first use
+_nonzero_static_support = {}
+
+
+def _nonzero(mask, size):
+    # Indices of the nonzeros of a 2-D mask whose count is already known. nonzero_static
+    # does not have to sync to size its output, but older torch lacks it or only ships
+    # a CPU kernel, in which case this falls back to nonzero
+    device_type = mask.device.type
+    if device_type not in _nonzero_static_support:
+        supported = hasattr(torch, 'nonzero_static')
+        if supported:
+            try:
+                torch.nonzero_static(torch.zeros((1, 1), dtype=torch.bool, device=mask.device), size=0)
+            except (NotImplementedError, RuntimeError):
+                supported = False
+        _nonzero_static_support[device_type] = supported
+    if _nonzero_static_support[device_type]:
+        return torch.nonzero_static(mask, size=size).unbind(1)
+    return mask.nonzero(as_tuple=True)
+
+def _take_rows(t, index):
+    # t[index] for an int32 index, index_select accepts it on every torch version
+    return t.index_select(0, index.reshape(-1)).view(*index.shape, *t.shape[1:])
 
 def k_reciprocal_re_ranking(queryFeat, galleryFeat, k1=20, k2=6, lambda_value=0.3):
     
     query_num = queryFeat.size(0)
     all_num = query_num + galleryFeat.size(0)
 
-    feat = torch.cat([queryFeat,galleryFeat])
-    distmat = torch.pow(feat,2).sum(dim=1, keepdim=True).expand(all_num,all_num) + torch.pow(feat, 2).sum(dim=1, keepdim=True).expand(all_num, all_num).t()
-    distmat.addmm_(1,-2,feat,feat.t())
-    original_dist = distmat.cpu().numpy()
+    feat = torch.cat([queryFeat,galleryFeat]).float()
+    if torch.cuda.is_available() and 6 * all_num ** 2 < torch.cuda.mem_get_info()[0]:
+        feat = feat.cuda()
+    else:
+        feat = feat.cpu()
+    distmat = _pairwise_euclid(feat)
     del feat
 
-    gallery_num = original_dist.shape[0]
-    original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
-    V = np.zeros_like(original_dist).astype(np.float16)
-    initial_rank = np.argsort(original_dist).astype(np.int32)
+    # Normalise and rank in float32 where the distances are computed, the N x N
+    # host copy only needs float16 once its values are in [0, 1]. Only the k1 + 1
+    # nearest neighbours of each row are ever read, so topk replaces a full sort
+    distmat = distmat.div_(distmat.max(dim=0, keepdim=True).values).t()
+    initial_rank = torch.topk(distmat, min(k1 + 1, all_num), dim=1, largest=False).indices
+    initial_rank = initial_rank.int().cpu().numpy()
+
+    # The N x N device to host copy goes to a pinned buffer without blocking, the
+    # neighbour expansion only needs initial_rank and runs while it is in flight
+    copied = None
+    if distmat.is_cuda:
+        original_dist = torch.empty((all_num, all_num), dtype=torch.float16, pin_memory=True)
+        original_dist.copy_(distmat, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record()
+    else:
+        original_dist = distmat.half()
+    del distmat
 
     print('Starting re-ranking')
-    for i in range(all_num):
-        # k-reciprocal neighbors
-        forward_k_neigh_index = initial_rank[i, :k1 + 1]
-        backward_k_neigh_index = initial_rank[forward_k_neigh_index, :k1 + 1]
-        fi = np.where(backward_k_neigh_index == i)[0]
-        k_reciprocal_index = forward_k_neigh_index[fi]
-        k_reciprocal_expansion_index = k_reciprocal_index
-
-        for j in range(len(k_reciprocal_index)):
-            candidate = k_reciprocal_index[j]
-            candidate_forward_k_neigh_index = initial_rank[candidate, :int(np.around(k1 / 2)) + 1]
-            candidate_backward_k_neigh_index = initial_rank[candidate_forward_k_neigh_index, :int(np.around(k1 / 2)) + 1]
-            fi_candidate = np.where(candidate_backward_k_neigh_index == candidate)[0]
-            candidate_k_reciprocal_index = candidate_forward_k_neigh_index[fi_candidate]
-
-            if len(np.intersect1d(candidate_k_reciprocal_index, k_reciprocal_index)) > 2 / 3 * len(candidate_k_reciprocal_index):
-                k_reciprocal_expansion_index = np.append(k_reciprocal_expansion_index, candidate_k_reciprocal_index)
-
-        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
-        weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
-        V[i, k_reciprocal_expansion_index] = weight / np.sum(weight)
+    index, count = k_reciprocal_expansion(initial_rank, k1, numba.get_num_threads())
+
+    if copied is not None:
+        copied.synchronize()
+    original_dist = original_dist.numpy()
+
+    rows = np.repeat(np.arange(all_num), count)
+    cols = index[np.arange(index.shape[1]) < count[:, np.newaxis]]
+    weight = np.exp(-original_dist[rows, cols].astype(np.float32))
+    V = sparse.csr_matrix((weight / np.bincount(rows, weights=weight)[rows], (rows, cols)), shape=(all_num, all_num))
+    del index, count, rows, cols, weight
 
     original_dist = original_dist[:query_num, ]
 
     if k2 != 1:
-        V_qe = np.zeros_like(V, dtype=np.float16)
+        # Query expansion averages the rows of the k2 nearest neighbours, i.e. a
+        # product with a sparse selector holding 1 / k2 at those positions
+        selector = sparse.csr_matrix((np.full(all_num * k2, 1 / k2, dtype=np.float32),
+                                      (np.repeat(np.arange(all_num), k2), initial_rank[:, :k2].ravel())),
+                                     shape=(all_num, all_num))
+        V = selector @ V
+        del selector
+
+    del initial_rank
 
-        for i in range(all_num):
-            V_qe[i, :] = np.mean(V[initial_rank[i, :k2], :], axis=0)
+    # V never becomes dense: its CSR rows give the support of every query and the
+    # CSC columns are the inverted index, both walked by the numba Jaccard kernel
+    V = V.tocsr()
+    V.sum_duplicates()
+    V_csc = V.tocsc()
 
-        V = V_qe
-        del V_qe
+    jaccard_dist = jaccard_distance(V.indptr, V.indices, V.data.astype(np.float32),
+                                    V_csc.indptr, V_csc.indices, V_csc.data.astype(np.float32),
+                                    query_num, numba.get_num_threads())
+    del V_csc
 
-    del initial_rank
-    invIndex = []
+    final_dist = jaccard_dist * (1 - lambda_value) + original_dist.astype(np.float32) * lambda_value
+
+    del original_dist
+    del V
+    del jaccard_dist
+
+    final_dist = final_dist[:query_num, query_num:]
+
+    return final_dist
+
+def _k_reciprocal_weights(feat, k1):
+    # Dense first half of k_re_ranking: distances, their row maxima, ranks and the
+    # k-reciprocal weights V. Every shape only depends on the number of images, so this
+    # part is compiled once per split on the device
+    all_num = feat.size(0)
+    device = feat.device
+
+    # The distances are symmetric, so normalising by the column maxima and transposing
+    # only scales every row by its own maximum. That leaves the ranking unchanged, the
+    # division is applied lazily where the normalised values are actually read
+    original_dist = _pairwise_euclid(feat)
+    row_max = original_dist.amax(dim=1, keepdim=True)
+    V = torch.zeros_like(original_dist)
+    # Ranks are kept in int32, which halves the traffic of every gather and comparison below
+    initial_rank = torch.topk(original_dist, min(k1 + 1, all_num), dim=1, largest=False).indices.int()
+
+    # k-reciprocal masks of every row, for both the k1 and the k1/2 neighbourhoods
+    half_k1 = int(round(k1 / 2)) + 1
+    rows = torch.arange(all_num, device=device, dtype=torch.int32).view(-1, 1, 1)
+    k_reciprocal_mask = (_take_rows(initial_rank, initial_rank) == rows).any(dim=2)
+    half_rank = initial_rank[:, :half_k1]
+    half_reciprocal_mask = (_take_rows(half_rank, half_rank) == rows).any(dim=2)
+
+    # For every row and k-reciprocal candidate: the candidate's own k1/2 reciprocal set,
+    # and which of its members also belong to the k-reciprocal set of the row
+    candidate_rank = _take_rows(half_rank, initial_rank)
+    candidate_mask = _take_rows(half_reciprocal_mask, initial_rank)
+    shared = ((candidate_rank.unsqueeze(3) == initial_rank.view(all_num, 1, 1, -1))
+              & k_reciprocal_mask.view(all_num, 1, 1, -1)).any(dim=3)
+    overlap = (shared & candidate_mask).sum(dim=2)
+    expand = k_reciprocal_mask & (overlap > 2 / 3 * candidate_mask.sum(dim=2))
+
+    # Membership of the expanded sets is scattered into V all rows at once, the
+    # counts also absorb the duplicates that np.unique used to remove
+    index = torch.cat([initial_rank, candidate_rank.view(all_num, -1)], dim=1)
+    flag = torch.cat([k_reciprocal_mask, (expand.unsqueeze(2) & candidate_mask).view(all_num, -1)], dim=1)
+    V.scatter_add_(1, index.long(), flag.float())
+
+    # Weights computed in place, so at most one N x N temporary sits next to original_dist and V
+    V = V.gt_(0).mul_(original_dist.div(row_max).neg_().exp_())
+    V.div_(V.sum(dim=1, keepdim=True))
+
+    # The weights are in [0, 1], V is kept in float16 from here on while original_dist
+    # stays in float32 for the final blend
+    return original_dist, row_max, V.half(), initial_rank
+
+# Compiled on the first device re-ranking, False once compiling turned out to be unsupported
+_compiled_k_reciprocal_weights = None
+
+def k_re_ranking(queryFeat, galleryFeat, k1=20, k2=6, lambda_value=0.3):
+    # Same algorithm as k_reciprocal_re_ranking, but every N x N matrix stays on the
+    # device and only the final query x gallery distances are copied back to the host
+    device = torch.device('cuda') if torch.cuda.is_available() else queryFeat.device
 
-    for i in range(gallery_num):
-        invIndex.append(np.where(V[:, i] != 0)[0])
+    query_num = queryFeat.size(0)
+    all_num = query_num + galleryFeat.size(0)
 
-    jaccard_dist = np.zeros_like(original_dist, dtype=np.float16)
+    feat = torch.cat([queryFeat, galleryFeat]).to(device, torch.float32)
 
-    for i in range(query_num):
-        temp_min = np.zeros(shape=[1, gallery_num], dtype=np.float16)
-        indNonZero = np.where(V[i, :] != 0)[0]
-        indImages = [invIndex[ind] for ind in indNonZero]
+    print('Starting re-ranking')
+    global _compiled_k_reciprocal_weights
+    if feat.is_cuda and _compiled_k_reciprocal_weights is None:
+        _compiled_k_reciprocal_weights = _try_compile(_k_reciprocal_weights, fullgraph=True, dynamic=False) or False
+    weights = None
+    if feat.is_cuda and _compiled_k_reciprocal_weights:
+        # The backend only compiles on the first call, where an unsupported setup fails
+        try:
+            weights = _compiled_k_reciprocal_weights(feat, k1)
+        except torch._dynamo.exc.TorchDynamoException as e:
+            print('Compiling the re-ranking failed, running it eagerly: {}'.format(e))
+            _compiled_k_reciprocal_weights = False
+    if weights is None:
+        weights = _k_reciprocal_weights(feat, k1)
+    original_dist, row_max, V, initial_rank = weights
+    del weights
+    del feat
 
-        for j in range(len(indNonZero)):
-            temp_min[0, indImages[j]] = temp_min[0, indImages[j]] + np.minimum(V[i, indNonZero[j]], V[indImages[j], indNonZero[j]])
+    original_dist = original_dist[:query_num].div_(row_max[:query_num])
+    del row_max
 
-        jaccard_dist[i] = 1 - temp_min / (2 - temp_min)
+    if k2 != 1:
+        # Query expansion as k2 whole-matrix row gathers summed into one float32
+        # accumulator, neither an [N, k2, N] gather nor a float32 copy of V is needed
+        V_qe = torch.zeros(V.shape, device=device)
+        for j in range(k2):
+            V_qe.add_(_take_rows(V, initial_rank[:, j]))
+        V = V_qe.div_(k2).half()
+        del V_qe
+
+    del initial_rank
+
+    # temp_min[i, k] = sum_j min(V[i, j], V[k, j]) only has terms where both are nonzero.
+    # Every nonzero (i, j) of a query row is paired with the nonzeros (k, j) of column j,
+    # taken from the nonzeros of V^T (the inverted index), and the minima are scattered
+    # into temp_min. The data-dependent sizes are read back up front so that nonzero
+    # and the repeat below are given their output sizes
+    mask = V != 0
+    col_count = mask.sum(dim=0)
+    row_ptr = F.pad(mask[:query_num].sum(dim=1).cumsum(0), (1, 0))
+    query_nnz, nnz = torch.stack([row_ptr[-1], col_count.sum()]).tolist()
+
+    query, support = _nonzero(mask[:query_num], query_nnz)
+    column, image = _nonzero(mask.t(), nnz)
+    col_ptr = F.pad(col_count.cumsum(0), (1, 0))
+    del mask, col_count
+
+    starts = col_ptr[support]
+    lengths = col_ptr[support + 1] - starts
+    shift = starts - lengths.cumsum(0) + lengths
+    values, col_values = V[query, support], V[image, column]
+    del V, column, col_ptr, starts
+
+    # The pairs are processed in chunks of whole query rows holding at most max_pairs
+    # of them, which bounds the gather memory; the pair offset of every row is the
+    # only other value read back
+    max_pairs = 2 ** 24
+    pair_ptr = F.pad(lengths.cumsum(0), (1, 0))[row_ptr]
+    row_ptr, pair_ptr = torch.stack([row_ptr, pair_ptr]).tolist()
+
+    temp_min = torch.zeros(query_num * all_num, device=device)
+    start = 0
+    while start < query_num:
+        end = max(bisect.bisect_right(pair_ptr, pair_ptr[start] + max_pairs) - 1, start + 1)
+        pair = torch.repeat_interleave(torch.arange(row_ptr[start], row_ptr[end], device=device),
+                                       lengths[row_ptr[start]:row_ptr[end]],
+                                       output_size=pair_ptr[end] - pair_ptr[start])
+        pos = torch.arange(pair_ptr[start], pair_ptr[end], device=device) + shift[pair]
+        # The minima are exact in float16, only their sums are accumulated in float32
+        temp_min.index_add_(0, query[pair] * all_num + image[pos], torch.minimum(values[pair], col_values[pos]).float())
+        start = end
+
+    temp_min = temp_min.view(query_num, all_num)
+    del query, support, image, lengths, shift, values, col_values, pair, pos
+
+    jaccard_dist = 1 - temp_min / (2 - temp_min)
 
     final_dist = jaccard_dist * (1 - lambda_value) + original_dist * lambda_value
 
     del original_dist
-    del V
     del jaccard_dist
 
-    final_dist = final_dist[:query_num, query_num:]
+    final_dist = final_dist[:, query_num:]
 
-    return final_dist
+    return final_dist.cpu().numpy()
 
-def extract_features(model, data_loader, print_freq=1, metric=None, norm=False):
+def extract_features(model, data_loader, print_freq=1, metric=None, norm=False, transform=None, return_gpu=False):
     model.eval()
     batch_time = AverageMeter()
     data_time = AverageMeter()
 
-    features = OrderedDict()
-    labels = OrderedDict()
+    fname_to_row = {}
+    labels = torch.empty(len(data_loader.dataset), dtype=torch.long)
+
+    # Every batch is copied into one preallocated (pinned) host buffer on a side
+    # stream, so the device to host transfer overlaps with the next forward pass.
+    # With return_gpu the buffer stays on the device of the outputs instead.
+    # Features are returned as that [N, D] buffer plus a fname -> row index, the
+    # labels as an [N] tensor in the same row order. Samplers may repeat or skip
+    # images (RandomIdentitySampler), so only the first occurrence of an image gets
+    # a row and the buffers are trimmed to the rows actually filled
+    feat_buf = None
+    copy_stream = None
+    offset = 0
 
     end = time.time()
     for i, (imgs, fnames, pids, _) in enumerate(data_loader):
         data_time.update(time.time() - end)
 
-        outputs = extract_cnn_feature(model, imgs, norm=norm)
-        for fname, output, pid in zip(fnames, outputs, pids):
-            features[fname] = output
-            labels[fname] = pid
+        outputs = extract_cnn_feature(model, imgs, norm=norm, return_gpu=True, transform=transform)
+
+        if feat_buf is None:
+            shape = (len(data_loader.dataset), outputs.size(1))
+            if return_gpu:
+                feat_buf = torch.empty(shape, dtype=outputs.dtype, device=outputs.device)
+            else:
+                feat_buf = torch.empty(shape, dtype=outputs.dtype, pin_memory=outputs.is_cuda)
+                if outputs.is_cuda:
+                    copy_stream = torch.cuda.Stream()
+
+        keep = []
+        for j, fname in enumerate(fnames):
+            if fname not in fname_to_row:
+                fname_to_row[fname] = offset + len(keep)
+                keep.append(j)
+        if len(keep) < len(fnames):
+            index = torch.tensor(keep, dtype=torch.long)
+            outputs = outputs[index.to(outputs.device)]
+            pids = pids[index]
+
+        batch = feat_buf[offset:offset + outputs.size(0)]
+
+        if copy_stream is not None:
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                batch.copy_(outputs, non_blocking=True)
+            outputs.record_stream(copy_stream)
+        else:
+            batch.copy_(outputs)
+
+        labels[offset:offset + outputs.size(0)] = pids
+        offset += outputs.size(0)
 
         batch_time.update(time.time() - end)
         end = time.time()
@@ -115,7 +356,46 @@ def extract_features(model, data_loader, print_freq=1, metric=None, norm=False):
                           batch_time.val, batch_time.avg,
                           data_time.val, data_time.avg))
 
-    return features, labels
+    if copy_stream is not None:
+        copy_stream.synchronize()
+
+    return (feat_buf[:offset], fname_to_row), labels[:offset]
+
+
+def precompute_index(features, query, gallery):
+    # Rows of the query/gallery images in the (tensor, fname -> row) features plus
+    # their ids and cameras, built once and reused by every later evaluation. The rows
+    # live on the device of the features so gathering them needs no upload
+    _, fname_to_row = features
+    query_index = torch.as_tensor([fname_to_row[f] for f, _, _ in query], dtype=torch.long, device=features[0].device)
+    gallery_index = torch.as_tensor([fname_to_row[f] for f, _, _ in gallery], dtype=torch.long, device=features[0].device)
+    query_ids = np.asarray([pid for _, pid, _ in query])
+    gallery_ids = np.asarray([pid for _, pid, _ in gallery])
+    query_cams = np.asarray([cam for _, _, cam in query])
+    gallery_cams = np.asarray([cam for _, _, cam in gallery])
+    return query_index, gallery_index, query_ids, gallery_ids, query_cams, gallery_cams
+
+
+def _row_index(features, items):
+    # items can also be the row indices returned by precompute_index
+    feat_tensor, fname_to_row = features
+    if isinstance(items, torch.Tensor):
+        return items.to(feat_tensor.device)
+    return torch.as_tensor([fname_to_row[f] for f, _, _ in items], device=feat_tensor.device)
+
+
+def _gather_features(features, query, gallery, metric=None):
+    feat_tensor = features[0]
+    query_index = _row_index(features, query)
+    gallery_index = _row_index(features, gallery)
+    if metric is None:
+        return feat_tensor.index_select(0, query_index), feat_tensor.index_select(0, gallery_index)
+
+    # Query and gallery share most of their images, so the metric transforms every
+    # distinct row once and both sides are gathered from the result
+    rows, inverse = torch.unique(torch.cat([query_index, gallery_index]), return_inverse=True)
+    z = metric.transform(feat_tensor.index_select(0, rows))
+    return z.index_select(0, inverse[:len(query_index)]), z.index_select(0, inverse[len(query_index):])
 
 
 def pairwise_distance(features, query=None, gallery=None, metric=None):
@@ -126,54 +406,29 @@ def pairwise_distance(features, query=None, gallery=None, metric=None):
 
     if useEuclidean or metric.algorithm == "euclidean":
         if query is None and gallery is None:
-            n = len(features)
-            x = torch.cat(list(features.values()))
-            x = x.view(n, -1)
+            x = features[0]
             if metric is not None:
                 x = metric.transform(x)
-            dist = torch.pow(x, 2).sum(dim=1, keepdim=True) * 2
-            dist = dist.expand(n, n) - 2 * torch.mm(x, x.t())
+            dist = _pairwise_euclid(x)
             return dist
 
-        x = torch.cat([features[f].unsqueeze(0) for f, _, _ in query], 0)
-        y = torch.cat([features[f].unsqueeze(0) for f, _, _ in gallery], 0)
-        m, n = x.size(0), y.size(0)
-        x = x.view(m, -1)
-        y = y.view(n, -1)
-        if metric is not None:
-            x = metric.transform(x)
-            y = metric.transform(y)
-        dist = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-            torch.pow(y, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        dist.addmm_(x, y.t(), beta=1, alpha=-2)
+        x, y = _gather_features(features, query, gallery, metric)
+        dist = _pairwise_euclid(x, y)
         return dist, x, y
     else:
         if query is None and gallery is None:
-            n = len(features)
-            x = torch.cat(list(features.values()))
-            x = x.view(n, -1)
+            x = features[0]
             if metric is not None:
                 x = metric.transform(x)
-            x_norm = x.norm(dim=1, keepdim=True)
-            x_normalized = x.div(x_norm)
-            dist = torch.mm(x_normalized, x_normalized.t())
-            dist = 1 - dist
+            x_n = F.normalize(x, dim=1)
+            dist = torch.addmm(x_n.new_ones(()), x_n, x_n.t(), alpha=-1)
             return dist
 
-        x = torch.cat([features[f].unsqueeze(0) for f, _, _ in query], 0)
-        y = torch.cat([features[f].unsqueeze(0) for f, _, _ in gallery], 0)
-        m, n = x.size(0), y.size(0)
-        x = x.view(m, -1)
-        y = y.view(n, -1)
-        if metric is not None:
-            x = metric.transform(x)
-            y = metric.transform(y)
-        x_norm = x.norm(dim=1, keepdim=True)
-        y_norm = y.norm(dim=1, keepdim=True)
-        x_normalized = x.div(x_norm)
-        y_normalized = y.div(y_norm)
-        dist = torch.mm(x_normalized, y_normalized.t())
-        dist = 1 - dist
+        x, y = _gather_features(features, query, gallery, metric)
+        x_n = F.normalize(x, dim=1)
+        y_n = F.normalize(y, dim=1)
+        # 1 - x_n.y_n^T as a single addmm, the GEMM writes straight on top of the broadcast ones
+        dist = torch.addmm(x_n.new_ones(()), x_n, y_n.t(), alpha=-1)
         return dist, x, y
 
 
@@ -216,18 +471,97 @@ def evaluate_all(distmat, dataset, query=None, gallery=None,
     return cmc_scores[dataset][0]
 
 
+def _feature_cache_key(model, data_loader, norm, transform=None):
+    # Cheap fingerprint of the architecture (its repr includes e.g. the conv strides),
+    # the state (first values of every parameter and buffer, so BatchNorm statistics
+    # count too), the images of the loader and both input pipelines (loader and batch
+    # transforms), so different models, checkpoints, splits and resolutions never collide
+    h = hashlib.blake2b(digest_size=8)
+    h.update(repr(model).encode())
+    for t in model.state_dict().values():
+        h.update(t.detach().flatten()[:16].cpu().numpy().tobytes())
+    for fname, _, _ in data_loader.dataset.dataset:
+        h.update(fname.encode())
+    h.update(repr(data_loader.dataset.transform).encode())
+    h.update(repr(transform).encode())
+    h.update(b'norm' if norm else b'')
+    return h.hexdigest()
+
+
 class Evaluator(object):
-    def __init__(self, model):
+    def __init__(self, model, transform=None, cache_dir=None):
         super(Evaluator, self).__init__()
         self.model = model
+        self.transform = transform
+        self.cache_dir = cache_dir
+        self._index = {}
+
+        # Evaluation batches always have the same shape, compiling the forward fuses its pointwise ops.
+        # The default mode is used since CUDA graphs would reuse the output buffers that are still being copied out
+        self.extractor = model
+        if torch.cuda.is_available():
+            compiled = _try_compile(model)
+            if compiled is not None:
+                self.extractor = compiled
 
     def evaluate(self, data_loader, query, gallery, dataset, metric=None, norm=False, re_ranking=False):
-        features, _ = extract_features(self.model, data_loader, norm=norm)
-        distmat, queryFeat, galleryFeat = pairwise_distance(features, query, gallery, metric=metric)
+        # Features, distances and re-ranking stay on the device unless a learned metric
+        # needs them on the host. Only cached features have to be uploaded
+        on_device = torch.cuda.is_available() and (metric is None or metric.algorithm in ('euclidean', 'cosine'))
+        features = self.extract(data_loader, norm=norm, return_gpu=on_device)
+        if on_device and not features[0].is_cuda:
+            features = (features[0].cuda(non_blocking=True), features[1])
+
+        # The same splits are evaluated every epoch, so their indices are only built once
+        key = (id(data_loader), id(query), id(gallery))
+        if key not in self._index:
+            self._index[key] = precompute_index(features, query, gallery)
+        query_index, gallery_index, query_ids, gallery_ids, query_cams, gallery_cams = self._index[key]
+
+        distmat, queryFeat, galleryFeat = pairwise_distance(features, query_index, gallery_index, metric=metric)
 
         if re_ranking:
-            final_ranking = k_reciprocal_re_ranking(queryFeat, galleryFeat)
-            return evaluate_all(final_ranking, dataset=dataset, query=query, gallery=gallery)
-            
-        else:
-            return evaluate_all(distmat, dataset=dataset, query=query, gallery=gallery)
+            distmat = self.rerank(queryFeat, galleryFeat)
+
+        # mean_ap and every cmc call would each copy a device distmat to the host
+        distmat = to_numpy(distmat)
+
+        return evaluate_all(distmat, dataset=dataset,
+                            query_ids=query_ids, gallery_ids=gallery_ids,
+                            query_cams=query_cams, gallery_cams=gallery_cams)
+
+    def extract(self, data_loader, norm=False, return_gpu=False):
+        if self.cache_dir is None:
+            features, _ = self._extract_features(data_loader, norm, return_gpu=return_gpu)
+            return features
+
+        fpath = osp.join(self.cache_dir, _feature_cache_key(self.model, data_loader, norm, self.transform) + '.pt')
+        if osp.isfile(fpath):
+            print("=> Loaded cached features '{}'".format(fpath))
+            return torch.load(fpath)
+
+        features, _ = self._extract_features(data_loader, norm)
+        mkdir_if_missing(self.cache_dir)
+        torch.save(features, fpath)
+        return features
+
+    def _extract_features(self, data_loader, norm, return_gpu=False):
+        # The backend only compiles on the first forward, so an unsupported setup (no Triton,
+        # a GPU it does not support) fails there and the evaluator switches to the eager model
+        if self.extractor is not self.model:
+            try:
+                return extract_features(self.extractor, data_loader, norm=norm, transform=self.transform, return_gpu=return_gpu)
+            except torch._dynamo.exc.TorchDynamoException as e:
+                print('=> Compiling the model failed, evaluating eagerly: {}'.format(e))
+                self.extractor = self.model
+        return extract_features(self.model, data_loader, norm=norm, transform=self.transform, return_gpu=return_gpu)
+
+    def rerank(self, queryFeat, galleryFeat):
+        all_num = queryFeat.size(0) + galleryFeat.size(0)
+
+        # The device re-ranking peaks at three float32 N x N matrices next to the features,
+        # a fourth one is kept as headroom. Use the host one when they do not fit
+        if torch.cuda.is_available() and 4 * all_num * (4 * all_num + queryFeat.size(1)) < torch.cuda.mem_get_info()[0]:
+            return k_re_ranking(queryFeat, galleryFeat)
+
+        return k_reciprocal_re_ranking(queryFeat, galleryFeat)
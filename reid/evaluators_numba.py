@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+from numba import njit, prange
+import numpy as np
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def k_reciprocal_expansion(initial_rank, k1, num_threads):
+    all_num, num_neigh = initial_rank.shape
+    half_k1 = min(round(k1 / 2) + 1, num_neigh)
+    max_len = num_neigh * (half_k1 + 1)
+
+    # Expanded neighbour sets are returned row by row as (index, count), the
+    # weights are computed by the caller since numba has no float16 support
+    index = np.zeros((all_num, max_len), dtype=np.int32)
+    count = np.zeros(all_num, dtype=np.int32)
+
+    for t in prange(num_threads):
+        # Thread-local buffers, reused for every row handled by this thread
+        seen = np.zeros(all_num, dtype=np.uint8)
+        reciprocal = np.empty(num_neigh, dtype=np.int32)
+        candidate_reciprocal = np.empty(half_k1, dtype=np.int32)
+        expansion = np.empty(max_len, dtype=np.int32)
+
+        for i in range(t, all_num, num_threads):
+            # k-reciprocal neighbors
+            num_reciprocal = 0
+            for a in range(num_neigh):
+                neigh = initial_rank[i, a]
+                for b in range(num_neigh):
+                    if initial_rank[neigh, b] == i:
+                        reciprocal[num_reciprocal] = neigh
+                        num_reciprocal += 1
+                        break
+
+            num_expansion = 0
+            for a in range(num_reciprocal):
+                expansion[num_expansion] = reciprocal[a]
+                num_expansion += 1
+                seen[reciprocal[a]] = 1
+
+            for a in range(num_reciprocal):
+                candidate = reciprocal[a]
+                num_candidate = 0
+                for c in range(half_k1):
+                    neigh = initial_rank[candidate, c]
+                    for d in range(half_k1):
+                        if initial_rank[neigh, d] == candidate:
+                            candidate_reciprocal[num_candidate] = neigh
+                            num_candidate += 1
+                            break
+
+                overlap = 0
+                for c in range(num_candidate):
+                    overlap += seen[candidate_reciprocal[c]]
+
+                if overlap > 2 / 3 * num_candidate:
+                    for c in range(num_candidate):
+                        expansion[num_expansion] = candidate_reciprocal[c]
+                        num_expansion += 1
+
+            for a in range(num_reciprocal):
+                seen[reciprocal[a]] = 0
+
+            # Sort + dedup in place of np.unique
+            expansion[:num_expansion].sort()
+            num_unique = 0
+            for a in range(num_expansion):
+                if a == 0 or expansion[a] != expansion[a - 1]:
+                    index[i, num_unique] = expansion[a]
+                    num_unique += 1
+            count[i] = num_unique
+
+    return index, count
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def jaccard_distance(indptr, indices, data, col_ptr, col_index, col_data, query_num, num_threads):
+    all_num = col_ptr.shape[0] - 1
+    jaccard_dist = np.empty((query_num, all_num), dtype=np.float32)
+
+    for t in prange(num_threads):
+        # Thread-local min-sum accumulator, cleared while each row is written out
+        temp_min = np.zeros(all_num, dtype=np.float32)
+
+        for i in range(t, query_num, num_threads):
+            # V is given as CSR (row support) and CSC (inverted index), only the
+            # columns where both V[i, j] and V[k, j] are nonzero contribute
+            for a in range(indptr[i], indptr[i + 1]):
+                j = indices[a]
+                value = data[a]
+                for b in range(col_ptr[j], col_ptr[j + 1]):
+                    temp_min[col_index[b]] += min(value, col_data[b])
+
+            for k in range(all_num):
+                jaccard_dist[i, k] = 1 - temp_min[k] / (2 - temp_min[k])
+                temp_min[k] = 0
+
+    return jaccard_dist
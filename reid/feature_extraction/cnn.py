@@ -6,17 +6,27 @@ import torch
 from ..utils import to_torch
 
 
-def extract_cnn_feature(model, inputs, modules=None, norm=False):
-    model.eval()
+def extract_cnn_feature(model, inputs, modules=None, norm=False, return_gpu=False, transform=None):
     inputs = to_torch(inputs)
 
+    # Inputs follow the model. They come from pinned DataLoader batches, so a copy to
+    # a CUDA device can overlap with compute
+    device = next(model.parameters()).device
+    inputs = inputs.to(device, non_blocking=device.type == 'cuda')
+    inputs = inputs.contiguous(memory_format=torch.channels_last)
+
+    if transform is not None:
+        inputs = transform(inputs)
+
     with torch.no_grad():
         if modules is None:
             if not norm:
                 outputs, _, _ = model(inputs)
             else:
                 _, outputs, _ = model(inputs)
-            outputs = outputs.data.cpu()
+            outputs = outputs.data
+            if not return_gpu:
+                outputs = outputs.cpu()
             return outputs
         # Register forward hook for each module
         outputs = OrderedDict()
@@ -9,10 +9,11 @@ from .evaluation_metrics import accuracy
 from .utils.meters import AverageMeter
 
 class BaseTrainer(object):
-    def __init__(self, model, criterion):
+    def __init__(self, model, criterion, transform=None):
         super(BaseTrainer, self).__init__()
         self.model = model
         self.criterion = criterion
+        self.transform = transform
 
     def train(self, epoch, data_loader, optimizer, print_freq=1):
         self.model.train()
@@ -62,13 +63,19 @@ class Trainer(BaseTrainer):
     def _parse_data(self, inputs):
 
         imgs, _, pids, _ = inputs
-        inputs = [Variable(imgs)]
 
         if torch.backends.mps.is_available():
             mps_device = torch.device("mps")
+            inputs = [Variable(imgs.to(mps_device))]
             targets = Variable(pids.to(mps_device))
         else:
-            targets = Variable(pids.cuda())
+            inputs = [Variable(imgs.cuda(non_blocking=True))]
+            targets = Variable(pids.cuda(non_blocking=True))
+
+        inputs = [imgs.contiguous(memory_format=torch.channels_last) for imgs in inputs]
+
+        if self.transform is not None:
+            inputs = [self.transform(imgs) for imgs in inputs]
         
         return inputs, targets
 
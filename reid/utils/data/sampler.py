@@ -4,22 +4,38 @@ from torch.utils.data.sampler import (Sampler)
 from collections import defaultdict
 import numpy as np
 import torch
+import math
 
 class RandomIdentitySampler(Sampler):
-    def __init__(self, data_source, num_instances=1):
+    def __init__(self, data_source, num_instances=1, num_replicas=1, rank=0, seed=0):
         self.data_source = data_source
         self.num_instances = num_instances
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
         self.index_dic = defaultdict(list)
         for index, (_, pid, _) in enumerate(data_source):
             self.index_dic[pid].append(index)
         self.pids = list(self.index_dic.keys())
-        self.num_samples = len(self.pids)
+        self.num_samples = int(math.ceil(len(self.pids) / num_replicas))
 
     def __len__(self):
         return self.num_samples * self.num_instances
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
     def __iter__(self):
-        indices = torch.randperm(self.num_samples)
+        if self.num_replicas > 1:
+            # Every rank draws the same identity permutation and keeps its own share
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.pids), generator=g)
+            indices = torch.cat([indices, indices[:self.num_samples * self.num_replicas - len(indices)]])
+            indices = indices[self.rank::self.num_replicas]
+        else:
+            indices = torch.randperm(self.num_samples)
         ret = []
         for i in indices:
             pid = self.pids[i]
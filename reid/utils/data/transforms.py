@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from torchvision.transforms import *
 from PIL import Image
 import random
+import torch
 import math
 
 
@@ -18,6 +19,10 @@ class RectScale(object):
             return img
         return img.resize((self.width, self.height), self.interpolation)
 
+    def __repr__(self):
+        return '{}(height={}, width={}, interpolation={})'.format(
+            self.__class__.__name__, self.height, self.width, self.interpolation)
+
 
 class RandomSizedRectCrop(object):
     def __init__(self, height, width, interpolation=Image.BILINEAR):
@@ -106,4 +111,31 @@ class RandomErasingAugmentation(object):
                     img[0, x_e:x_e + H_e, y_e:y_e + W_e] = mean[0]
                
                 return img
-# -----------------------------
\ No newline at end of file
+# -----------------------------
+
+
+# Batched counterparts of Normalize and RandomHorizontalFlip, applied on the device
+# to a whole [B, C, H, W] batch instead of image by image in the loader workers
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, imgs):
+        if self.mean.device != imgs.device:
+            self.mean = self.mean.to(imgs.device)
+            self.std = self.std.to(imgs.device)
+        return (imgs - self.mean) / self.std
+
+    def __repr__(self):
+        return '{}(mean={}, std={})'.format(
+            self.__class__.__name__, self.mean.flatten().tolist(), self.std.flatten().tolist())
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        flip = torch.rand(imgs.size(0), device=imgs.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), imgs.flip(-1), imgs)
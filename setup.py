@@ -8,7 +8,7 @@ setup(name='open-reid',
       url='https://github.com/andreaunitn/Progetto-Signal-Image-and-Video',
       license='MIT',
       install_requires=[
-          'numpy', 'scipy', 'torch', 'torchvision',
+          'numpy', 'scipy', 'numba', 'torch', 'torchvision',
           'six', 'h5py', 'Pillow',
           'scikit-learn', 'metric-learn'],
       extras_require={
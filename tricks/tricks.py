@@ -1,6 +1,7 @@
 import os.path as osp
 import subprocess
 import argparse
+import os
 
 def main(args):
     batch_size = args.k * args.p
@@ -12,12 +13,18 @@ def main(args):
     epochs = args.epochs
     logs_dir = args.logs_dir
 
+    # with more than one GPU, torchrun starts one training process per GPU
+    launcher = "python" if args.gpus <= 1 else "torchrun --nproc_per_node={}".format(args.gpus)
+
     # command to execute triplet loss
-    command = "python triplet_loss.py -d {} -b {} -t {} --num-instances {} -j 2 -a resnet50 --logs-dir {} --epochs {} --combine-trainval".format(dataset, batch_size, trick_number, k, logs_dir, epochs)
+    command = "{} triplet_loss.py -d {} -b {} -t {} --num-instances {} -j 2 -a resnet50 --logs-dir {} --epochs {} --combine-trainval".format(launcher, dataset, batch_size, trick_number, k, logs_dir, epochs)
     #command = "python triplet_loss.py -d {} -b {} -t {} --num-instances {} -j 2 -a resnet50 --logs-dir {} --epochs {} --combine-trainval --evaluate --cross_domain --resume logs/model_best.pth.tar".format(dataset, batch_size, trick_number, k, logs_dir, epochs)
     #command = "python triplet_loss.py -d {} -b {} -t {} --num-instances {} -j 2 -a resnet50 --logs-dir {} --epochs {} --combine-trainval --evaluate --re_ranking --resume logs/model_best.pth.tar".format(dataset, batch_size, trick_number, k, logs_dir, epochs)
     #command = "python triplet_loss.py -d {} -b {} -t {} --num-instances {} -j 2 -a resnet50 --logs-dir {} --epochs {} --combine-trainval --resume logs/checkpoint.pth.tar".format(dataset, batch_size, trick_number, k, logs_dir, epochs)
-    subprocess.run(command, shell = True)
+
+    # ring allreduce for the DDP gradient buckets
+    env = dict(os.environ, NCCL_ALGO = "Ring")
+    subprocess.run(command, shell = True, env = env)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Bag of Tricks and A Strong Baseline for Deep Person Re-identification")
@@ -37,6 +44,9 @@ if __name__ == "__main__":
     # number of epochs
     parser.add_argument("--epochs", type = int, default = 120, help = "number of epochs")
 
+    # number of GPUs
+    parser.add_argument("--gpus", type = int, default = 1, help = "number of GPUs, one training process is started for each of them")
+
     # logs file
     working_dir = osp.dirname(osp.abspath(__file__))
     parser.add_argument("--data-dir", type = str, metavar = "PATH", default = osp.join(working_dir, "data"))
@@ -1,9 +1,13 @@
 from __future__ import print_function, absolute_import
+from collections import OrderedDict
 import os.path as osp
 import argparse
+import os
 
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.backends import cudnn
+import torch.distributed as dist
 from torch import nn
 import numpy as np
 import torch
@@ -25,56 +29,56 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
-def get_data(name, split_id, data_dir, height, width, batch_size, num_instances, workers, combine_trainval, tricks):
+def get_data(name, split_id, data_dir, height, width, batch_size, num_instances, workers, combine_trainval, tricks, num_replicas=1, rank=0):
     root = osp.join(data_dir, name)
 
     dataset = datasets.create(name, root, split_id=split_id)
 
-    normalizer = T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-
     train_set = dataset.trainval if combine_trainval else dataset.train
     num_classes = (dataset.num_trainval_ids if combine_trainval else dataset.num_train_ids)
 
+    # Flipping and normalisation are applied on the device to whole batches (see main)
     # -----------------------------
     # Trick 2: Random Erasing Augmentation
     if tricks < 2:
         train_transformer = T.Compose([
             T.RandomSizedRectCrop(height, width),
-            T.RandomHorizontalFlip(),
             T.ToTensor(),
-            normalizer,
         ])
     else:
         train_transformer = T.Compose([
             T.RandomSizedRectCrop(height, width), 
-            T.RandomHorizontalFlip(),
             T.ToTensor(),
             T.RandomErasingAugmentation(height, width),
-            normalizer,
         ])
     # -----------------------------
 
     test_transformer = T.Compose([
         T.RectScale(height, width),
         T.ToTensor(),
-        normalizer,
     ])
 
+    # Keep the workers alive between epochs and let each one prefetch a couple of batches
+    worker_args = dict(persistent_workers=True, prefetch_factor=2) if workers > 0 else {}
+
     train_loader = DataLoader(
         Preprocessor(train_set, root=dataset.images_dir, transform=train_transformer), 
         batch_size=batch_size, num_workers=workers,
-        sampler=RandomIdentitySampler(train_set, num_instances),
-        pin_memory=True, drop_last=True)
+        sampler=RandomIdentitySampler(train_set, num_instances, num_replicas=num_replicas, rank=rank),
+        pin_memory=True, drop_last=True, **worker_args)
 
     val_loader = DataLoader(
         Preprocessor(dataset.val, root=dataset.images_dir, transform=test_transformer),
         batch_size=batch_size, num_workers=workers,
-        shuffle=False, pin_memory=True)
+        shuffle=False, pin_memory=True, **worker_args)
+
+    # Query and gallery share images, keep one copy of each in a stable order
+    test_set = list(OrderedDict.fromkeys(dataset.query + dataset.gallery))
 
     test_loader = DataLoader(
-        Preprocessor(list(set(dataset.query) | set(dataset.gallery)), root=dataset.images_dir, transform=test_transformer),
+        Preprocessor(test_set, root=dataset.images_dir, transform=test_transformer),
         batch_size=batch_size, num_workers=workers,
-        shuffle=False, pin_memory=True)
+        shuffle=False, pin_memory=True, **worker_args)
 
     return dataset, num_classes, train_loader, val_loader, test_loader
 
@@ -83,31 +87,43 @@ def main(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     cudnn.benchmark = True
+    cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
 
     argv = sys.argv
 
+    # Distributed training, one process per GPU when launched with torchrun
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    world_size, rank = 1, 0
+    if distributed:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+
     # Redirect print to both console and log file
-    if not args.evaluate:
+    if not args.evaluate and rank == 0:
         sys.stdout = Logger(osp.join(args.logs_dir, 'log.txt'), "".join(argv))
 
     # Create data loaders
     assert args.num_instances > 1, "num_instances should be greater than 1"
-    assert args.batch_size % args.num_instances == 0, 'num_instances should divide batch_size'
+    assert args.batch_size % (args.num_instances * world_size) == 0, 'num_instances times the number of processes should divide batch_size'
+    batch_size = args.batch_size // world_size
     
     if args.height is None or args.width is None:
         args.height, args.width = (256, 128)
     
-    dataset, num_classes, train_loader, val_loader, test_loader = get_data(args.dataset, args.split, args.data_dir, args.height, args.width, args.batch_size, args.num_instances, args.workers, args.combine_trainval, args.t)
+    dataset, num_classes, train_loader, val_loader, test_loader = get_data(args.dataset, args.split, args.data_dir, args.height, args.width, batch_size, args.num_instances, args.workers, args.combine_trainval, args.t, num_replicas=world_size, rank=rank)
 
     # Cross domain
     if args.cross_domain:
         cross_dataset_name = ''
         if args.dataset == 'market1501':
             cross_dataset_name = 'dukemtmc'
-            cross_dataset, _, cross_train_loader, cross_val_loader, cross_test_loader = get_data(cross_dataset_name, args.split, args.data_dir, args.height, args.width, args.batch_size, args.num_instances, args.workers, args.combine_trainval, args.t)
+            cross_dataset, _, cross_train_loader, cross_val_loader, cross_test_loader = get_data(cross_dataset_name, args.split, args.data_dir, args.height, args.width, batch_size, args.num_instances, args.workers, args.combine_trainval, args.t, num_replicas=world_size, rank=rank)
         else:
             cross_dataset_name = 'market1501'
-            cross_dataset, _, cross_train_loader, cross_val_loader, cross_test_loader = get_data(cross_dataset_name, args.split, args.data_dir, args.height, args.width, args.batch_size, args.num_instances, args.workers, args.combine_trainval, args.t)
+            cross_dataset, _, cross_train_loader, cross_val_loader, cross_test_loader = get_data(cross_dataset_name, args.split, args.data_dir, args.height, args.width, batch_size, args.num_instances, args.workers, args.combine_trainval, args.t, num_replicas=world_size, rank=rank)
 
     # -----------------------------
     # Trick 4: Last Stride
@@ -138,13 +154,32 @@ def main(args):
         best_top1 = checkpoint['best_top1']
         print("=> Start epoch {}  best top1 {:.1%}".format(start_epoch, best_top1))
 
+    # NHWC layout lets the convolutions use the Tensor Core kernels, set before wrapping the model
+    model = model.to(memory_format=torch.channels_last)
+
     # Enabling GPU acceleration on Mac devices
     if torch.backends.mps.is_available():
         mps_device = torch.device("mps")
         model = nn.DataParallel(model).to(mps_device)
+    elif distributed:
+        # Larger buckets overlap the allreduce with more of the backward pass, and the static
+        # graph lets DDP skip the unused-parameter search (base.fc never receives gradients)
+        model = DistributedDataParallel(model.cuda(local_rank), device_ids=[local_rank],
+                                        bucket_cap_mb=50, gradient_as_bucket_view=True,
+                                        static_graph=True, find_unused_parameters=False)
     else:
         model = nn.DataParallel(model).cuda()
 
+    # Evaluation only runs on rank 0, on the bare module so that no collective is issued
+    eval_model = model.module if distributed else model
+
+    # Batch transforms run on the device after the loaders hand over the images
+    normalizer = T.BatchNormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    train_batch_transformer = T.Compose([
+        T.BatchRandomHorizontalFlip(),
+        normalizer,
+    ])
+
     # Distance metric
     metric = DistanceMetric(algorithm=args.dist_metric)
 
@@ -157,18 +192,22 @@ def main(args):
     # -----------------------------
 
     # Evaluator
-    evaluator = Evaluator(model)
+    # Features are only cached for --evaluate runs, during training the weights change every epoch
+    evaluator = Evaluator(eval_model, transform=normalizer, cache_dir=args.feature_cache if args.evaluate else None)
 
     if args.evaluate:
+        if rank != 0:
+            dist.destroy_process_group()
+            return
         if args.cross_domain:
-            metric.train(model, cross_train_loader)
+            metric.train(eval_model, cross_train_loader, transform=normalizer)
             print("Validation:")
             evaluator.evaluate(cross_val_loader, cross_dataset.val, cross_dataset.val, cross_dataset_name, metric, norm=norm, re_ranking=False)
             print("Test:")
             evaluator.evaluate(cross_test_loader, cross_dataset.query, cross_dataset.gallery, cross_dataset_name, metric, norm=norm, re_ranking=re_ranking)
             return
         else:
-            metric.train(model, train_loader)
+            metric.train(eval_model, train_loader, transform=normalizer)
             print("Validation:")
             evaluator.evaluate(val_loader, dataset.val, dataset.val, args.dataset, metric, norm=norm, re_ranking=False)
             print("Test:")
@@ -204,41 +243,53 @@ def main(args):
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
 
     # Trainer
-    trainer = Trainer(model, criterion)
+    trainer = Trainer(model, criterion, transform=train_batch_transformer)
 
     # -----------------------------
     # Trick 1: Warmup Learning Rate
-    def adjust_lr(epoch):
+    def lr_factor(epoch):
 
         if args.t < 1:
             if epoch <= 39:
-                lr = args.lr
+                return 1
             elif 40 <= epoch <= 69:
-                lr = args.lr * 0.1
+                return 0.1
             else:
-                lr = args.lr * 0.1 * 0.1
+                return 0.1 * 0.1
         else:
             if epoch <= 10:
-                lr = args.lr * (epoch * 0.1)
+                return epoch * 0.1
             elif 11 <= epoch <= 40:
-                lr = args.lr
+                return 1
             elif 41 <= epoch <= 70:
-                lr = args.lr * 0.1
+                return 0.1
             else:
-                lr = args.lr * 0.1 * 0.1
+                return 0.1 * 0.1
 
-        
-        for g in optimizer.param_groups:
-            g['lr'] = lr * g.get('lr_mult', 1)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lr_factor)
     # -----------------------------
 
+    # Resume the optimizer and the schedule, checkpoints saved without them are fast-forwarded
+    if args.resume:
+        if 'scheduler' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        else:
+            for _ in range(start_epoch):
+                scheduler.step()
+
     # Start training
     for epoch in range(start_epoch, args.epochs):
-        adjust_lr(epoch)
+        train_loader.sampler.set_epoch(epoch)
         trainer.train(epoch, train_loader, optimizer)
+        scheduler.step()
         
         if epoch < args.start_save:
             continue
+
+        if rank != 0:
+            dist.barrier()
+            continue
         
         top1 = evaluator.evaluate(val_loader, dataset.val, dataset.val, args.dataset, norm=norm, re_ranking=False)
 
@@ -248,22 +299,34 @@ def main(args):
             'state_dict': model.module.state_dict(),
             'epoch': epoch + 1,
             'best_top1': best_top1,
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
         }, is_best, fpath=osp.join(args.logs_dir, 'checkpoint.pth.tar'))
 
         print('\n * Finished epoch {:3d}  rank-1: {:5.1%}  best: {:5.1%}{}\n'.format(epoch, top1, best_top1, ' *' if is_best else ''))
 
+        if distributed:
+            dist.barrier()
+
+    if rank != 0:
+        dist.destroy_process_group()
+        return
+
     # Final test
     print('Test with best model:')
     checkpoint = load_checkpoint(osp.join(args.logs_dir, 'model_best.pth.tar'))
     model.module.load_state_dict(checkpoint['state_dict'])
 
     if args.cross_domain:
-        metric.train(model, cross_train_loader)
+        metric.train(eval_model, cross_train_loader, transform=normalizer)
         evaluator.evaluate(cross_test_loader, cross_dataset.query, cross_dataset.gallery, cross_dataset_name, metric, norm=norm, re_ranking=re_ranking)
     else:
-        metric.train(model, train_loader)
+        metric.train(eval_model, train_loader, transform=normalizer)
         evaluator.evaluate(test_loader, dataset.query, dataset.gallery, args.dataset, metric, norm=norm, re_ranking=re_ranking)
 
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Person re-identification training and evaluation parameters")
@@ -294,6 +357,7 @@ if __name__ == '__main__':
     # training configs
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--evaluate', action='store_true', help="evaluation only")
+    parser.add_argument('--feature-cache', type=str, default=None, metavar='PATH', help="directory where features extracted with --evaluate are cached")
     parser.add_argument('--epochs', type=int, default=120)
     parser.add_argument('--start_save', type=int, default=0, help="start saving checkpoints after specific epoch")
     parser.add_argument('--seed', type=int, default=1)